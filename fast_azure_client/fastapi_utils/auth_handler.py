@@ -1,9 +1,22 @@
+from typing import Optional
+
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from fastapi.concurrency import run_in_threadpool
 from fastapi import Security
 from functools import wraps
+from cachetools import TTLCache
+
+from ..graph_utils import BatchingGraphClient
+from .token_validators import decode_token, requires_jwks_fetch
+
+import threading
+
 
-from ..graph_utils import GraphAPI
-from .token_validators import decode_token
+# graph user details keyed by (client_id, email, given_name), user documents rarely change
+_USER_CACHE = TTLCache(maxsize=10_000, ttl=60)
+_USER_CACHE_LOCK = threading.Lock()
+
+_MISSING = object()
 
 
 class AuthHandler:
@@ -17,20 +30,30 @@ class AuthHandler:
         client_id (str): The client ID of the application.
         client_secret (str): The client secret of the application.
         tenant_id (str): The ID of the Azure AD tenant.
+        jwks_url (str, optional): The JWKS url used to verify token signatures. Defaults to None.
 
     Attributes:
         security (HTTPBearer): The security scheme for bearer tokens.
+        graph_client (BatchingGraphClient): Client used to batch user lookups against the Graph API.
 
     """
 
     security = HTTPBearer()
 
-    def __init__(self, client_id: str, client_secret: str, tenant_id: str):
+    def __init__(self, client_id: str, client_secret: str, tenant_id: str, jwks_url: Optional[str] = None):
         self.client_id = client_id
         self.client_secret = client_secret
         self.tenant_id = tenant_id
+        self.jwks_url = jwks_url
+
+        # shared across requests so concurrent lookups can be coalesced into graph $batch calls
+        self.graph_client = BatchingGraphClient(
+            client_id=client_id,
+            client_secret=client_secret,
+            tenant_id=tenant_id
+        )
 
-    def auth_wrapper(self, auth: HTTPAuthorizationCredentials = Security(security)):
+    async def auth_wrapper(self, auth: HTTPAuthorizationCredentials = Security(security)):
         """
         Authentication wrapper for handling token verification and user details retrieval from azure.
 
@@ -41,18 +64,31 @@ class AuthHandler:
             dict: User details retrieved from the Graph API.
 
         """
-        valid_token_data = decode_token(auth.credentials, client_id=self.client_id)
+        if requires_jwks_fetch(auth.credentials, self.jwks_url):
+            # fetching the jwks is blocking http, keep it off the event loop
+            valid_token_data = await run_in_threadpool(decode_token, auth.credentials,
+                                                       client_id=self.client_id, jwks_url=self.jwks_url)
+        else:
+            valid_token_data = decode_token(auth.credentials, client_id=self.client_id, jwks_url=self.jwks_url)
+
         unique_name = valid_token_data.get('preferred_username')
         emails = valid_token_data.get('emails', [None])
 
         email = unique_name if unique_name else emails[0]
 
-        # Setup Graph API
-        graph_api = GraphAPI(
-            client_id=self.client_id,
-            client_secret=self.client_secret,
-            tenant_id=self.tenant_id
-        )
+        given_name = valid_token_data.get("name")
+
+        # reuse recently fetched user details instead of asking graph on every request
+        cache_key = (self.client_id, email, given_name)
+
+        with _USER_CACHE_LOCK:
+            user = _USER_CACHE.get(cache_key, _MISSING)
+
+        if user is _MISSING:
+            user = await self.graph_client.get_user_details(email=email, given_name=given_name)
+
+            with _USER_CACHE_LOCK:
+                _USER_CACHE[cache_key] = user
 
-        user = graph_api.get_user_details(email=email, given_name=valid_token_data.get("name"))
-        return user
+        # hand out a copy so routes can't modify the cached user
+        return dict(user) if user is not None else None
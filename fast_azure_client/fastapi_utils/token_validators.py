@@ -1,9 +1,56 @@
+from typing import Optional
+
 from fastapi import HTTPException
+from jwt import ExpiredSignatureError, InvalidTokenError, DecodeError, PyJWKSetError
+from cachetools import TTLCache
+from hashlib import blake2b
+
+from ..graph_utils.main import _SESSION
 
-import base64
+import threading
+import requests
 import time
 import json
 import jwt
+import re
+
+# pybase64 is a requirement for its simd accelerated decoder, the stdlib keeps installs without it working
+try:
+    from pybase64 import urlsafe_b64decode
+except ImportError:
+    from base64 import urlsafe_b64decode
+
+# orjson parses bytes directly and its errors subclass json.JSONDecodeError
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# verified token payloads keyed by a digest of the raw token, expiry is still checked on every hit
+_TOKEN_CACHE = TTLCache(maxsize=10_000, ttl=60)
+_TOKEN_CACHE_LOCK = threading.Lock()
+
+# signing keys keyed by jwks url -> (keys by kid, fetched_at, expires_at)
+_JWKS_CACHE: dict = {}
+_JWKS_CACHE_LOCK = threading.Lock()
+
+# used when the jwks response has no Cache-Control max-age
+_JWKS_DEFAULT_MAX_AGE = 24 * 60 * 60
+
+# minimum seconds between refetches triggered by an unknown key id
+_JWKS_MIN_REFRESH_INTERVAL = 5 * 60
+
+# seconds to wait on the jwks endpoint before giving up
+_JWKS_TIMEOUT = 10
+
+# after a failed jwks fetch, seconds to wait before trying again (stale keys are served meanwhile)
+_JWKS_RETRY_INTERVAL = 30
+
+# monotonic time of the last failed fetch per jwks url
+_JWKS_FAILED_AT: dict = {}
+
+# one lock per jwks url so only a single thread refetches a key set at a time
+_JWKS_FETCH_LOCKS: dict = {}
 
 
 def verify_token_not_expired(payload):
@@ -14,14 +61,24 @@ def verify_token_not_expired(payload):
         payload (dict): The payload of the JWT token.
 
     Raises:
-        jwt.ExpiredSignatureError: If the token has expired.
+        ExpiredSignatureError: If the token has expired.
 
     """
     token_expiration_time: int = payload.get('exp', 0)
-    current_time: int = int(time.time())
 
-    if current_time >= token_expiration_time:
-        raise jwt.ExpiredSignatureError
+    # comparing the float timestamp against the int expiry directly avoids the int() conversion
+    if time.time() >= token_expiration_time:
+        raise ExpiredSignatureError
+
+
+def _token_application_id(payload: dict):
+    # get the application id be it from ad or b2c tokens
+    # (only fall back to 'aud' when needed, a default argument would always look it up)
+    token_application_id = payload.get('appid')
+    if token_application_id is None:
+        token_application_id = payload.get('aud', 0)
+
+    return token_application_id
 
 
 def verify_user_is_authorized_for_this_app(payload: dict, client_id: str):
@@ -36,11 +93,8 @@ def verify_user_is_authorized_for_this_app(payload: dict, client_id: str):
         HTTPException: If the user is not authorized to use this application (status_code=401).
 
     """
-    # get the application id be it from ad or b2c tokens
-    token_application_id = payload.get('appid', payload.get('aud', 0))
-
     # verify the token's ID is the same as the client ID
-    is_valid_token = token_application_id == client_id
+    is_valid_token = _token_application_id(payload) == client_id
 
     if not is_valid_token:
         raise HTTPException(status_code=401, detail='User is not authorized to use this application')
@@ -57,38 +111,230 @@ def parse_token(token: str) -> dict:
         dict: The decoded payload as a dictionary.
 
     Raises:
-        jwt.InvalidTokenError: If the token format is incorrect.
+        InvalidTokenError: If the token format is incorrect.
 
     """
     try:
-        _, payload, _ = token.split('.')
+        # locate the payload segment in place instead of splitting into three strings
+        token_bytes = token.encode('ascii')
+        payload_start = token_bytes.index(b'.') + 1
+        payload_end = token_bytes.index(b'.', payload_start)
+
+        if token_bytes.find(b'.', payload_end + 1) != -1:
+            raise ValueError("Token must have exactly three segments")
 
-        decoded_payload = base64.urlsafe_b64decode(payload + '===')
-        decoded_payload_str = decoded_payload.decode('utf-8')
+        padding = b'=' * (-(payload_end - payload_start) % 4)
+        decoded_payload = urlsafe_b64decode(token_bytes[payload_start:payload_end] + padding)
 
-        return json.loads(decoded_payload_str)
+        # json accepts utf-8 bytes directly, so skip the intermediate str
+        return json_loads(decoded_payload)
 
     except (ValueError, UnicodeDecodeError, json.JSONDecodeError) as e:
-        raise jwt.DecodeError("Failed to decode token payload") from e
+        raise DecodeError("Failed to decode token payload") from e
+
+
+def get_signing_key(jwks_url: str, kid: str) -> jwt.PyJWK:
+    """
+    Get the signing key with the given key id, fetching the JWKS only when the cached copy is stale.
+
+    The cache honours the Cache-Control max-age of the JWKS response, and an unknown key id triggers
+    a refetch (at most once every few minutes) to pick up rotated keys. If the JWKS can't be fetched,
+    the previously fetched keys keep being used.
+
+    Args:
+        jwks_url (str): The URL of the JSON Web Key Set.
+        kid (str): The key id from the token header.
+
+    Returns:
+        jwt.PyJWK: The matching signing key.
+
+    Raises:
+        InvalidTokenError: If no key with the given id exists.
+        HTTPException: If the JWKS can't be fetched and no cached key matches (status_code=503).
+
+    """
+    signing_key = _get_cached_signing_key(jwks_url, kid)
+    if signing_key is not None:
+        return signing_key
+
+    with _JWKS_CACHE_LOCK:
+        fetch_lock = _JWKS_FETCH_LOCKS.setdefault(jwks_url, threading.Lock())
+
+    # only one thread refetches, the others wait for it and then use the refreshed cache
+    with fetch_lock:
+        signing_key = _get_cached_signing_key(jwks_url, kid)
+        if signing_key is not None:
+            return signing_key
+
+        return _refresh_signing_key(jwks_url, kid)
+
+
+def _get_cached_signing_key(jwks_url: str, kid: str) -> Optional[jwt.PyJWK]:
+    """
+    Get the signing key from the cache, or None if the JWKS needs to be fetched.
+    """
+    with _JWKS_CACHE_LOCK:
+        cached = _JWKS_CACHE.get(jwks_url)
+
+    if not cached:
+        return None
+
+    now = time.monotonic()
+    keys, fetched_at, expires_at = cached
+
+    if now >= expires_at:
+        return None
+
+    if kid in keys:
+        return keys[kid]
+
+    # unknown key ids only trigger a refetch once in a while, so they can't be used to hammer the endpoint
+    if now - fetched_at < _JWKS_MIN_REFRESH_INTERVAL:
+        raise InvalidTokenError("Unable to find a signing key that matches the token")
+
+    return None
+
+
+def _refresh_signing_key(jwks_url: str, kid: str) -> jwt.PyJWK:
+    """
+    Fetch the JWKS and return the matching key, falling back to the stale keys if the fetch fails.
+    """
+    now = time.monotonic()
+
+    with _JWKS_CACHE_LOCK:
+        stale_keys = _JWKS_CACHE.get(jwks_url, ({}, 0.0, 0.0))[0]
+        failed_at = _JWKS_FAILED_AT.get(jwks_url)
+
+    if failed_at is None or now - failed_at >= _JWKS_RETRY_INTERVAL:
+        try:
+            response = _SESSION.get(jwks_url, timeout=_JWKS_TIMEOUT)
+            response.raise_for_status()
 
+            keys = {key.key_id: key for key in jwt.PyJWKSet.from_json(response.text).keys}
+
+        except (requests.RequestException, PyJWKSetError, ValueError):
+            with _JWKS_CACHE_LOCK:
+                _JWKS_FAILED_AT[jwks_url] = now
+
+        else:
+            max_age = re.search(r'max-age=(\d+)', response.headers.get('Cache-Control', ''))
+            max_age = int(max_age.group(1)) if max_age else _JWKS_DEFAULT_MAX_AGE
+
+            with _JWKS_CACHE_LOCK:
+                _JWKS_CACHE[jwks_url] = (keys, now, now + max_age)
+                _JWKS_FAILED_AT.pop(jwks_url, None)
+
+            if kid not in keys:
+                raise InvalidTokenError("Unable to find a signing key that matches the token")
+
+            return keys[kid]
+
+    # the jwks endpoint is unavailable, keep verifying with the keys fetched before
+    if kid in stale_keys:
+        return stale_keys[kid]
+
+    raise HTTPException(status_code=503, detail='Unable to fetch the token signing keys')
+
+
+def verify_token_signature(token: str, jwks_url: str) -> dict:
+    """
+    Verify the token's signature against the signing keys published at the JWKS url.
+
+    Args:
+        token (str): The token to verify.
+        jwks_url (str): The URL of the JSON Web Key Set.
+
+    Returns:
+        dict: The verified payload as a dictionary.
+
+    Raises:
+        InvalidTokenError: If the signature is invalid or the token can't be decoded.
+
+    """
+    header = jwt.get_unverified_header(token)
+    signing_key = get_signing_key(jwks_url, header.get('kid'))
+
+    # audience is checked separately since ad tokens may carry the app id in 'appid' instead
+    return jwt.decode(token, signing_key.key, algorithms=["RS256"], options={"verify_aud": False})
+
+
+def requires_jwks_fetch(token: str, jwks_url: Optional[str]) -> bool:
+    """
+    Check whether decoding the token may have to fetch the JWKS, i.e. block on the network.
+
+    Tokens already in the decode cache, and tokens whose signing key is cached, are verified in memory.
+
+    Args:
+        token (str): The token to decode.
+        jwks_url (str, optional): The JWKS url used to verify the token's signature.
+
+    Returns:
+        bool: True if decode_token may make a network request for this token.
+
+    """
+    if not jwks_url:
+        return False
+
+    with _TOKEN_CACHE_LOCK:
+        if _token_cache_key(token, jwks_url) in _TOKEN_CACHE:
+            return False
 
-def decode_token(token: str, client_id: str) -> dict:
     try:
-        payload = parse_token(token)
+        kid = jwt.get_unverified_header(token).get('kid')
+        return _get_cached_signing_key(jwks_url, kid) is None
+
+    except InvalidTokenError:
+        # decode_token rejects these without fetching anything
+        return False
 
-        # verify token isn't expired
-        verify_token_not_expired(payload)
 
-        # verify token is for this application
+def _token_cache_key(token: str, jwks_url: Optional[str]) -> tuple:
+    return jwks_url, blake2b(token.encode(), digest_size=16).digest()
+
+
+def decode_token(token: str, client_id: str, jwks_url: Optional[str] = None) -> dict:
+    """
+    Decode and validate a bearer token.
+
+    Args:
+        token (str): The token to decode.
+        client_id (str): The ID of the client application.
+        jwks_url (str, optional): The JWKS url used to verify the token's signature.
+            The signature is not verified when this is not set. Defaults to None.
+
+    Returns:
+        dict: The token payload with the raw token under 'access_token'.
+
+    Raises:
+        HTTPException: If the token is expired, invalid or not for this application (status_code=401).
+
+    """
+    try:
+        # reuse the decoded payload if this token has been seen recently
+        cache_key = _token_cache_key(token, jwks_url)
+
+        with _TOKEN_CACHE_LOCK:
+            payload = _TOKEN_CACHE.get(cache_key)
+
+        if payload is None:
+            payload = verify_token_signature(token, jwks_url) if jwks_url else parse_token(token)
+
+        # cached payloads are checked again, they may have expired since they were cached
+        verify_token_not_expired(payload)
         verify_user_is_authorized_for_this_app(payload, client_id)
 
+        with _TOKEN_CACHE_LOCK:
+            _TOKEN_CACHE[cache_key] = payload
+
+        # hand out a copy so callers can't modify the cached payload
+        payload = dict(payload)
         payload["access_token"] = token
         return payload
 
-    except jwt.ExpiredSignatureError:
+    except ExpiredSignatureError:
         raise HTTPException(
             status_code=401, detail='Signature has expired')
 
-    except jwt.InvalidTokenError as e:
+    except InvalidTokenError as e:
         raise HTTPException(status_code=401, detail='Invalid token')
 
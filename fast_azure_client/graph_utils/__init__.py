@@ -1 +1,3 @@
-from .main import GraphAPI
\ No newline at end of file
+from .main import GraphAPI
+from .async_main import AsyncGraphAPI
+from .batching import BatchingGraphClient
@@ -0,0 +1,343 @@
+from typing import IO, AsyncIterator, Optional, Union
+
+from . import configs
+from .main import (GraphAPI, json_loads, b64encode_as_string, get_cached_access_token, cache_access_token,
+                   access_token_request, split_batch_groups, split_batch_responses)
+
+import threading
+import asyncio
+import weakref
+import httpx
+
+
+# one shared client per event loop, pooled connections can't be used from another loop
+_ASYNC_CLIENTS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+_ASYNC_CLIENTS_LOCK = threading.Lock()
+
+
+def _get_async_client() -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+
+    with _ASYNC_CLIENTS_LOCK:
+        client = _ASYNC_CLIENTS.get(loop)
+
+        if client is None or client.is_closed:
+            # drop clients of loops that have been closed, their connections can't be reused
+            for closed_loop in [other for other in _ASYNC_CLIENTS if other.is_closed()]:
+                del _ASYNC_CLIENTS[closed_loop]
+
+            # retries only cover connection failures, throttled batch requests are retried in send_batch
+            transport = httpx.AsyncHTTPTransport(
+                http2=True,
+                retries=3,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+            )
+            client = httpx.AsyncClient(transport=transport, timeout=10.0)
+            _ASYNC_CLIENTS[loop] = client
+
+        return client
+
+
+class AsyncGraphAPI:
+
+    def __init__(self, access_token: Optional[str] = None, client_id: Optional[str] = None,
+                 tenant_id: Optional[str] = None, client_secret: Optional[str] = None):
+        """
+        Async class for interacting with Microsoft Graph API.
+
+        Mirrors GraphAPI, but all requests are awaited on an httpx client shared by everything running
+        on the same event loop. When no access token is provided, an app-only token is taken from the
+        shared token cache on each request and refreshed when it is about to expire.
+
+        Args:
+            access_token (str, optional): Access token for API authentication. Defaults to None.
+            client_id (str, optional): Client ID for API authentication. Defaults to None.
+            tenant_id (str, optional): Tenant ID for API authentication. Defaults to None.
+            client_secret (str, optional): Client secret for API authentication. Defaults to None.
+        """
+
+        self.client_secret = client_secret
+        self.client_id = client_id
+        self.tenant_id = tenant_id
+
+        # set access token to class
+        self.access_token = access_token
+
+        # without a caller provided token, app-only tokens are taken from the shared cache on every
+        # request, so long-lived instances pick up refreshed tokens instead of using an expired one
+        self._uses_app_token = not access_token
+
+    @property
+    def _client(self) -> httpx.AsyncClient:
+        # resolved per request so an instance can be used from whichever loop is running
+        return _get_async_client()
+
+    async def get_user_details(self, email: str = None, object_id: str = None, given_name: str = None) -> dict:
+        """
+        Get a user by object id, or the first user matching the email or given name.
+
+        Returns:
+            dict: User details, or None if no user matched.
+
+        """
+        headers = await self._get_headers()
+
+        # get user details directly using object id
+        if object_id:
+            response = await self._client.get(f'{configs.user_list_url}/{object_id}',
+                                              params={"$select": configs.user_select_fields}, headers=headers)
+            response.raise_for_status()
+
+            return json_loads(response.content)
+
+        # query users by email or given name and let graph do the filtering
+        params = GraphAPI._user_lookup_params(email, given_name)
+        if params is None:
+            return None
+
+        # advanced queries on /users require eventual consistency
+        headers["ConsistencyLevel"] = "eventual"
+
+        response = await self._client.get(configs.user_list_url, params=params, headers=headers)
+        response.raise_for_status()
+
+        data = json_loads(response.content)
+        return data["value"][0] if data["value"] else None
+
+    async def update_user_details(self, object_id: str, requested_updates: dict) -> dict:
+        """
+        Update user details in Microsoft Graph API.
+
+        Args:
+            object_id (str): User's object ID.
+            requested_updates (dict): Requested updates to user details.
+
+        Returns:
+            dict: Updated user details.
+
+        """
+        response = await self._client.patch(f'{configs.user_list_url}/{object_id}',
+                                            json=requested_updates, headers=await self._get_headers())
+        response.raise_for_status()
+
+        # graph answers updates with 204 no content, so read back just the selected fields
+        if response.status_code == 204:
+            return await self.get_user_details(object_id=object_id)
+
+        return json_loads(response.content)
+
+    async def get_user_profile(self, object_id: str) -> str:
+        """
+        Get user profile image from Microsoft Graph API.
+
+        Args:
+            object_id (str): User's object ID.
+
+        Returns:
+            str: Base64 encoded image string.
+
+        """
+        # images are already compressed so skip transfer encoding
+        headers = await self._get_headers()
+        headers.pop("Content-Type")
+        headers["Accept-Encoding"] = "identity"
+
+        response = await self._client.get(f'{configs.user_list_url}/{object_id}/photo/$value',
+                                          headers=headers)
+
+        # verify the user has a profile details
+        if response.status_code == 404:
+            return None
+
+        # raise error for other cases
+        response.raise_for_status()
+
+        encoded_image_data = b64encode_as_string(response.content)
+        return f"data:image/png;base64,{encoded_image_data}"
+
+    async def update_user_profile(self, object_id: str, file_data: Union[bytes, IO[bytes]],
+                                  content_type: str = "image/png"):
+        """
+        Update user profile image in Microsoft Graph API.
+
+        Args:
+            object_id (str): User's object ID.
+            file_data (bytes | IO[bytes]): Binary data of the new profile image, or a binary file-like
+                object to stream it from (e.g. UploadFile.file) without reading it into memory first.
+            content_type (str, optional): Content type of the profile image. Defaults to "image/png".
+
+        Returns:
+            None
+
+        """
+        headers = await self._get_headers(content_type=content_type)
+
+        content = file_data
+        if not isinstance(file_data, (bytes, bytearray, memoryview)):
+            # the async client only streams async iterables, send the size up front to avoid chunking
+            content_length = self._remaining_size(file_data)
+            if content_length is not None:
+                headers["Content-Length"] = str(content_length)
+
+            content = self._iter_file(file_data)
+
+        # Post new image to Microsoft Graph API
+        response = await self._client.put(f'{configs.user_list_url}/{object_id}/photo/$value',
+                                          content=content, headers=headers)
+        response.raise_for_status()
+
+    async def create_user_on_azure(self, user_data: dict) -> dict:
+        """
+        Creates a user on Azure Active Directory using the Microsoft Graph API.
+
+        Args:
+            user_data (dict): User data including properties required for user creation.
+
+        Returns:
+            dict: User object representing the created user.
+
+        Raises:
+            httpx.HTTPStatusError: If the API request fails.
+
+        """
+        response = await self._client.post(configs.user_list_url, json=user_data,
+                                           headers=await self._get_headers())
+        response.raise_for_status()
+        return json_loads(response.content)
+
+    async def create_users_on_azure(self, users: list) -> list:
+        """
+        Creates several users on Azure Active Directory in as few requests as possible.
+
+        Args:
+            users (list): User data dicts, each as accepted by create_user_on_azure.
+
+        Returns:
+            list: (status, body) pairs in the same order as users. Created users have status 201 and
+                the user object as body. Failed (or still throttled) users keep their status code and
+                the Graph error body, so callers can tell which users need to be retried.
+
+        Raises:
+            httpx.HTTPStatusError: If a batch request itself fails.
+
+        """
+        batch_requests = GraphAPI._create_users_batch_requests(users)
+        responses = await self.send_batch(batch_requests)
+
+        return [(responses[request["id"]]["status"], responses[request["id"]].get("body"))
+                for request in batch_requests]
+
+    async def create_new_user_fields(self, custom_fields: dict):
+        """
+        Adds custom data to Microsoft Graph for a user.
+
+        Args:
+            custom_fields (dict): A dictionary containing the custom data to add.
+
+        Raises:
+            httpx.HTTPStatusError: If the API request fails.
+
+        """
+        # update custom_fields
+        custom_fields["targetObjects"] = ["User"]
+
+        # handle response
+        response = await self._client.post(f'{configs.application_list_url}/extensionProperties',
+                                           json=custom_fields, headers=await self._get_headers())
+        response.raise_for_status()
+        return json_loads(response.content)
+
+    async def send_batch(self, batch_requests: list, max_retries: int = 3) -> dict:
+        """
+        Send sub-requests to the Microsoft Graph JSON $batch endpoint.
+
+        Behaves like GraphAPI.send_batch, but groups of 20 are sent concurrently.
+
+        Args:
+            batch_requests (list): Batch sub-requests, each with a unique "id", "method" and relative "url".
+            max_retries (int, optional): Times to resend throttled sub-requests. Defaults to 3.
+
+        Returns:
+            dict: Sub-responses keyed by their request id.
+
+        Raises:
+            httpx.HTTPStatusError: If the batch request itself fails.
+
+        """
+        headers = await self._get_headers()
+
+        responses = {}
+        for group_responses in await asyncio.gather(*[self._send_batch_group(group, headers, max_retries)
+                                                      for group in split_batch_groups(batch_requests)]):
+            responses.update(group_responses)
+
+        return responses
+
+    async def _send_batch_group(self, pending: list, headers: dict, max_retries: int) -> dict:
+        responses = {}
+
+        for attempt in range(max_retries + 1):
+            response = await self._client.post(configs.batch_url, json={"requests": pending}, headers=headers)
+            response.raise_for_status()
+
+            throttled_ids, retry_after = split_batch_responses(json_loads(response.content), responses,
+                                                               retry_throttled=attempt < max_retries)
+            if not throttled_ids:
+                break
+
+            # wait out the throttle window, then resend only the throttled sub-requests
+            await asyncio.sleep(retry_after)
+            pending = [request for request in pending if request["id"] in throttled_ids]
+
+        return responses
+
+    @staticmethod
+    def _remaining_size(file_data: IO[bytes]) -> Optional[int]:
+        """
+        Get the number of bytes left to read in a seekable file, or None if it can't be determined.
+        """
+        try:
+            position = file_data.tell()
+            end = file_data.seek(0, 2)
+            file_data.seek(position)
+        except (AttributeError, OSError):
+            return None
+
+        return end - position
+
+    @staticmethod
+    async def _iter_file(file_data: IO[bytes], chunk_size: int = 64 * 1024) -> AsyncIterator[bytes]:
+        while chunk := file_data.read(chunk_size):
+            yield chunk
+
+    async def _get_headers(self, content_type: str = "application/json") -> dict:
+        if self._uses_app_token:
+            self.access_token = await self._get_graph_api_access_token()
+
+        return {
+            "Authorization": f"Bearer {self.access_token}",
+            "Content-Type": content_type
+        }
+
+    async def _get_graph_api_access_token(self):
+        """
+        Retrieve the access token for Microsoft Graph API using client credentials.
+        Shares the per (client_id, tenant_id) token cache with GraphAPI.
+
+        Returns:
+            str: Access token for Microsoft Graph API.
+
+        Raises:
+            httpx.HTTPStatusError: If there's an error in the request or response.
+
+        """
+        cached_token = get_cached_access_token(self.client_id, self.tenant_id)
+        if cached_token:
+            return cached_token
+
+        url, request_data = access_token_request(self.client_id, self.client_secret, self.tenant_id)
+
+        response = await self._client.post(url, data=request_data)
+        response.raise_for_status()
+
+        return cache_access_token(self.client_id, self.tenant_id, json_loads(response.content))
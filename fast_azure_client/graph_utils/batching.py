@@ -0,0 +1,155 @@
+from typing import Optional
+from urllib.parse import quote, urlencode
+
+from . import configs
+from .main import GraphAPI
+from .async_main import AsyncGraphAPI
+
+import threading
+import asyncio
+import weakref
+import httpx
+
+
+class BatchingGraphClient:
+    """
+    Coalesces concurrent user lookups into Microsoft Graph JSON $batch requests.
+
+    Lookups are queued and, after a short debounce window, flushed together in batches of up
+    to 20 sub-requests. Each caller awaits a future which resolves with its own sub-response.
+
+    Args:
+        client_id (str): Client ID for API authentication.
+        client_secret (str): Client secret for API authentication.
+        tenant_id (str): Tenant ID for API authentication.
+        debounce (float, optional): Seconds to wait for more lookups before flushing. Defaults to 0.01.
+
+    """
+
+    def __init__(self, client_id: str, client_secret: str, tenant_id: str, debounce: float = 0.01):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.tenant_id = tenant_id
+        self.debounce = debounce
+
+        # queue and worker task per event loop, created lazily since they belong to the loop that uses them
+        self._workers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, tuple]" = weakref.WeakKeyDictionary()
+        self._workers_lock = threading.Lock()
+
+    async def get_user_details(self, email: Optional[str] = None, given_name: Optional[str] = None) -> Optional[dict]:
+        """
+        Look up a single user by email or given name as part of the next batch.
+
+        Args:
+            email (str, optional): The user's email. Defaults to None.
+            given_name (str, optional): The user's given name. Defaults to None.
+
+        Returns:
+            dict: The matching user, or None if no user was found.
+
+        Raises:
+            httpx.HTTPStatusError: If the lookup fails.
+
+        """
+        params = GraphAPI._user_lookup_params(email, given_name)
+        if params is None:
+            return None
+
+        loop = asyncio.get_running_loop()
+        queue = self._get_queue(loop)
+
+        future = loop.create_future()
+        await queue.put((params, future))
+        return await future
+
+    def _get_queue(self, loop: asyncio.AbstractEventLoop) -> asyncio.Queue:
+        with self._workers_lock:
+            worker_state = self._workers.get(loop)
+
+            if worker_state is None or worker_state[1].done():
+                # drop the state of loops that have been closed, their workers can't run anymore
+                for closed_loop in [other for other in self._workers if other.is_closed()]:
+                    del self._workers[closed_loop]
+
+                queue = asyncio.Queue()
+                worker_state = (queue, loop.create_task(self._run(queue, loop)))
+                self._workers[loop] = worker_state
+
+            return worker_state[0]
+
+    async def _run(self, queue: asyncio.Queue, loop: asyncio.AbstractEventLoop):
+        # keep references to in-flight flushes so they aren't garbage collected
+        flushes = set()
+
+        while True:
+            pending = [await queue.get()]
+
+            # give concurrent callers a moment to join this batch
+            if queue.qsize() < configs.batch_max_requests - 1:
+                await asyncio.sleep(self.debounce)
+
+            while len(pending) < configs.batch_max_requests and not queue.empty():
+                pending.append(queue.get_nowait())
+
+            # flush in the background so the next batch can start filling straight away
+            flush = loop.create_task(self._flush(pending))
+            flushes.add(flush)
+            flush.add_done_callback(flushes.discard)
+
+    async def _flush(self, pending: list):
+        # identical lookups in the same batch share a single sub-request
+        lookups = {}
+        for params, future in pending:
+            url = f"/users?{urlencode(params, safe='$,', quote_via=quote)}"
+            lookups.setdefault(url, []).append(future)
+
+        batch_requests = [
+            {
+                "id": str(index),
+                "method": "GET",
+                "url": url,
+                "headers": {"ConsistencyLevel": "eventual"},
+            }
+            for index, url in enumerate(lookups)
+        ]
+
+        try:
+            graph_api = AsyncGraphAPI(
+                client_id=self.client_id,
+                client_secret=self.client_secret,
+                tenant_id=self.tenant_id
+            )
+            responses = await graph_api.send_batch(batch_requests)
+
+            for request, futures in zip(batch_requests, lookups.values()):
+                item = responses[request["id"]]
+
+                for future in futures:
+                    # the caller may have been cancelled while the batch was in flight
+                    if future.done():
+                        continue
+
+                    if item["status"] >= 400:
+                        future.set_exception(self._sub_request_error(request, item))
+                        continue
+
+                    # copy per caller since the same user may be handed to several requests
+                    users = item["body"]["value"]
+                    future.set_result(dict(users[0]) if users else None)
+
+        except Exception as e:
+            # fail every caller still waiting, otherwise they would wait forever
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+
+    @staticmethod
+    def _sub_request_error(request: dict, item: dict) -> httpx.HTTPStatusError:
+        """
+        Build the error for a failed sub-request, the same as a direct request would raise.
+        """
+        http_request = httpx.Request(request["method"], f"{configs.graph_base_url}{request['url']}")
+        http_response = httpx.Response(item["status"], json=item.get("body"), request=http_request)
+
+        return httpx.HTTPStatusError(f"{item['status']} Error for url {http_request.url}",
+                                     request=http_request, response=http_response)
@@ -1,8 +1,17 @@
 
+graph_base_url = 'https://graph.microsoft.com/v1.0'
+
 profile_photo_url = 'https://graph.microsoft.com/v1.0/me/photo/$value'
 
 user_details_url = 'https://graph.microsoft.com/v1.0/me'
 
 user_list_url = 'https://graph.microsoft.com/v1.0/users'
 
+user_select_fields = 'id,mail,givenName,displayName,userPrincipalName'
+
 application_list_url = 'https://graph.microsoft.com/v1.0/users'
+
+batch_url = 'https://graph.microsoft.com/v1.0/$batch'
+
+# graph rejects $batch payloads with more than this many sub-requests
+batch_max_requests = 20
@@ -1,9 +1,149 @@
-from typing import Optional
+from typing import IO, Optional, Union
 
 from . import configs
 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import threading
 import requests
 import base64
+import time
+
+# pybase64 (a requirement) encodes profile photos with simd, the stdlib keeps installs without it working
+try:
+    from pybase64 import b64encode_as_string
+except ImportError:
+    def b64encode_as_string(data: bytes) -> str:
+        return base64.b64encode(data).decode('ascii')
+
+# orjson is considerably faster on large graph payloads, fall back to the stdlib parser
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+
+class _GraphRetry(Retry):
+    """
+    Retry policy for the shared session which only retries POSTs when graph throttled them.
+
+    A 5xx (or a read error) on a POST may arrive after graph already committed it, e.g. created a user,
+    so resending it could create duplicates. POST is therefore left out of allowed_methods, and only
+    let through here for 429 responses.
+    """
+
+    def is_retry(self, method: str, status_code: int, has_retry_after: bool = False) -> bool:
+        if method.upper() == "POST":
+            return bool(self.total) and status_code == 429
+
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+# shared session so connections to graph / login endpoints are pooled and kept alive
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=_GraphRetry(
+        total=3,
+        backoff_factor=0.2,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(["GET", "PUT", "PATCH"]),
+        raise_on_status=False  # hand the last response back so raise_for_status() still applies
+    )
+))
+
+
+# app-only graph tokens keyed by (client_id, tenant_id) -> (access_token, refresh_at)
+_TOKEN_CACHE: dict = {}
+_TOKEN_CACHE_LOCK = threading.Lock()
+
+# refresh cached tokens this many seconds before they actually expire
+_TOKEN_EXPIRY_MARGIN = 60
+
+
+def get_cached_access_token(client_id: str, tenant_id: str) -> Optional[str]:
+    """
+    Get the cached app-only access token for the client and tenant, if it is still valid.
+    """
+    with _TOKEN_CACHE_LOCK:
+        cached = _TOKEN_CACHE.get((client_id, tenant_id))
+
+    if cached and time.monotonic() < cached[1]:
+        return cached[0]
+
+    return None
+
+
+def cache_access_token(client_id: str, tenant_id: str, token_data: dict) -> str:
+    """
+    Cache the access token from a token endpoint response until shortly before it expires.
+
+    Returns:
+        str: The access token.
+
+    """
+    access_token = token_data["access_token"]
+    expires_in = int(token_data.get("expires_in", 0))
+
+    with _TOKEN_CACHE_LOCK:
+        _TOKEN_CACHE[(client_id, tenant_id)] = (access_token, time.monotonic() + expires_in - _TOKEN_EXPIRY_MARGIN)
+
+    return access_token
+
+
+def access_token_request(client_id: str, client_secret: str, tenant_id: str) -> tuple:
+    """
+    Build the url and form data for requesting an app-only Graph token with client credentials.
+
+    Returns:
+        tuple: The token endpoint url and the form data to post to it.
+
+    """
+    request_data = {
+        "client_id": client_id,
+        "scope": "https://graph.microsoft.com/.default",
+        "client_secret": client_secret,
+        "grant_type": "client_credentials",
+    }
+
+    url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
+    return url, request_data
+
+
+def split_batch_groups(batch_requests: list) -> list:
+    """
+    Split batch sub-requests into groups no larger than Graph accepts in a single $batch request.
+    """
+    return [batch_requests[start:start + configs.batch_max_requests]
+            for start in range(0, len(batch_requests), configs.batch_max_requests)]
+
+
+def split_batch_responses(batch_response: dict, responses: dict, retry_throttled: bool) -> tuple:
+    """
+    Sort the sub-responses of a $batch response into finished and throttled ones.
+
+    Args:
+        batch_response (dict): The parsed $batch response body.
+        responses (dict): Finished sub-responses keyed by request id, updated in place.
+        retry_throttled (bool): Whether throttled sub-requests will be resent. If not, they count as finished.
+
+    Returns:
+        tuple: The ids of the throttled sub-requests, and the largest Retry-After among them in seconds.
+
+    """
+    throttled_ids = set()
+    retry_after = 0.0
+
+    for item in batch_response["responses"]:
+        if item["status"] == 429 and retry_throttled:
+            throttled_ids.add(item["id"])
+            retry_after = max(retry_after, float(item.get("headers", {}).get("Retry-After", 1)))
+        else:
+            responses[item["id"]] = item
+
+    return throttled_ids, retry_after
 
 
 class GraphAPI:
@@ -37,31 +177,30 @@ class GraphAPI:
         self.access_token = access_token
 
     def get_user_details(self, email: str = None, object_id: str = None, given_name: str = None) -> dict:
-        # parse given name
-        given_name = given_name if not given_name else given_name.lower()
-
         # get user details directly using object id
         if object_id:
-            response = requests.get(f'{configs.user_list_url}/{object_id}',
+            response = _SESSION.get(f'{configs.user_list_url}/{object_id}',
+                                    params={"$select": configs.user_select_fields},
                                     headers=self.headers)
             response.raise_for_status()
 
-            return response.json()
+            return json_loads(response.content)
 
-        # get all users and filter by email
+        # query users by email or given name and let graph do the filtering
         else:
-            response = requests.get(configs.user_list_url,
-                                    headers=self.headers)
-            response.raise_for_status()
+            params = self._user_lookup_params(email, given_name)
+            if params is None:
+                return None
 
-            data = response.json()
-            user_list = data["value"]
+            # advanced queries on /users require eventual consistency
+            headers = {**self.headers, "ConsistencyLevel": "eventual"}
 
-            # get the first user with expected email from a filtered list
-            filtered_list = list(filter(lambda x: x["mail"] == email or str(x["givenName"]).lower() == given_name,
-                                        user_list))
-            user = next(iter(filtered_list), None)
-            return user
+            response = _SESSION.get(configs.user_list_url, params=params,
+                                    headers=headers)
+            response.raise_for_status()
+
+            data = json_loads(response.content)
+            return data["value"][0] if data["value"] else None
 
     def update_user_details(self, object_id: str, requested_updates: dict) -> dict:
         """
@@ -76,12 +215,15 @@ class GraphAPI:
 
         """
 
-        response = requests.patch(f'{configs.user_list_url}/{object_id}',
+        response = _SESSION.patch(f'{configs.user_list_url}/{object_id}',
                                   json=requested_updates, headers=self.headers)
-        print(response.json())
         response.raise_for_status()
 
-        return response.json()
+        # graph answers updates with 204 no content, so read back just the selected fields
+        if response.status_code == 204:
+            return self.get_user_details(object_id=object_id)
+
+        return json_loads(response.content)
 
     def get_user_profile(self, object_id: str) -> str:
         """
@@ -94,11 +236,14 @@ class GraphAPI:
             str: Base64 encoded image string.
 
         """
-        # define headers
-        headers = {"Authorization": f"Bearer {self.access_token}"}
+        # define headers, images are already compressed so skip transfer encoding
+        headers = {
+            "Authorization": f"Bearer {self.access_token}",
+            "Accept-Encoding": "identity"
+        }
 
         # get new image from ms graph
-        response = requests.get(f'{configs.user_list_url}/{object_id}/photo/$value',
+        response = _SESSION.get(f'{configs.user_list_url}/{object_id}/photo/$value',
                                 headers=headers)
 
         # verify the user has a profile details
@@ -109,19 +254,17 @@ class GraphAPI:
         response.raise_for_status()
 
         # parse response and get data
-        data = response.content
-        encoded_image_data = base64.b64encode(data).decode('utf-8')
+        encoded_image_data = b64encode_as_string(response.content)
+        return f"data:image/png;base64,{encoded_image_data}"
 
-        image_string = "data:image/png;base64," + encoded_image_data
-        return image_string
-
-    def update_user_profile(self, object_id: str, file_data: bytes, content_type: str = "image/png"):
+    def update_user_profile(self, object_id: str, file_data: Union[bytes, IO[bytes]], content_type: str = "image/png"):
         """
         Update user profile image in Microsoft Graph API.
 
         Args:
             object_id (str): User's object ID.
-            file_data (bytes): Binary data of the new profile image.
+            file_data (bytes | IO[bytes]): Binary data of the new profile image, or a binary file-like
+                object to stream it from (e.g. UploadFile.file) without reading it into memory first.
             content_type (str, optional): Content type of the profile image. Defaults to "image/png".
 
         Returns:
@@ -134,7 +277,8 @@ class GraphAPI:
         }
 
         # Post new image to Microsoft Graph API
-        response = requests.put(f'{configs.user_list_url}/{object_id}/photo/$value',
+        # (requests streams file-like objects and sets Content-Length itself when the size is known)
+        response = _SESSION.put(f'{configs.user_list_url}/{object_id}/photo/$value',
                                 data=file_data, headers=headers)
         response.raise_for_status()
 
@@ -183,9 +327,39 @@ class GraphAPI:
                 "userPrincipalName": "AdeleV@contoso.onmicrosoft.com"
             }
         """
-        response = requests.post(configs.user_list_url, json=user_data, headers=self.headers)
+        response = _SESSION.post(configs.user_list_url, json=user_data, headers=self.headers)
         response.raise_for_status()
-        return response.json()
+        return json_loads(response.content)
+
+    def create_users_on_azure(self, users: list) -> list:
+        """
+        Creates several users on Azure Active Directory in as few requests as possible.
+
+        Graph doesn't accept lists of users, so the users are sent as JSON $batch sub-requests,
+        20 at a time.
+
+        Args:
+            users (list): User data dicts, each as accepted by create_user_on_azure.
+
+        Returns:
+            list: (status, body) pairs in the same order as users. Created users have status 201 and
+                the user object as body. Failed (or still throttled) users keep their status code and
+                the Graph error body, so callers can tell which users need to be retried.
+
+        Raises:
+            requests.HTTPError: If a batch request itself fails.
+
+        Example:
+            >>> api = GraphAPI(access_token, client_id, tenant_id, client_secret)
+            >>> results = api.create_users_on_azure([adele_data, alex_data])
+            >>> failed = [index for index, (status, _) in enumerate(results) if status >= 400]
+
+        """
+        batch_requests = self._create_users_batch_requests(users)
+        responses = self.send_batch(batch_requests)
+
+        return [(responses[request["id"]]["status"], responses[request["id"]].get("body"))
+                for request in batch_requests]
 
     def create_new_user_fields(self, custom_fields: dict):
         """
@@ -215,14 +389,100 @@ class GraphAPI:
         custom_fields["targetObjects"] = ["User"]
 
         # handle response
-        response = requests.post(f'{configs.application_list_url}/extensionProperties',
+        response = _SESSION.post(f'{configs.application_list_url}/extensionProperties',
                                  json=custom_fields, headers=self.headers)
         response.raise_for_status()
-        return response.json()
+        return json_loads(response.content)
+
+    def send_batch(self, batch_requests: list, max_retries: int = 3) -> dict:
+        """
+        Send sub-requests to the Microsoft Graph JSON $batch endpoint.
+
+        Requests are split into groups of at most 20 (the Graph limit), and sub-requests throttled
+        with a 429 are resent after the largest Retry-After returned for the group.
+
+        Args:
+            batch_requests (list): Batch sub-requests, each with a unique "id", "method" and relative "url".
+            max_retries (int, optional): Times to resend throttled sub-requests. Defaults to 3.
+
+        Returns:
+            dict: Sub-responses keyed by their request id.
+
+        Raises:
+            requests.HTTPError: If the batch request itself fails.
+
+        """
+        responses = {}
+
+        for pending in split_batch_groups(batch_requests):
+            for attempt in range(max_retries + 1):
+                response = _SESSION.post(configs.batch_url, json={"requests": pending}, headers=self.headers)
+                response.raise_for_status()
+
+                throttled_ids, retry_after = split_batch_responses(json_loads(response.content), responses,
+                                                                   retry_throttled=attempt < max_retries)
+                if not throttled_ids:
+                    break
+
+                # wait out the throttle window, then resend only the throttled sub-requests
+                time.sleep(retry_after)
+                pending = [request for request in pending if request["id"] in throttled_ids]
+
+        return responses
+
+    @staticmethod
+    def _create_users_batch_requests(users: list) -> list:
+        """
+        Build the $batch sub-requests for creating the given users.
+        """
+        return [
+            {
+                "id": str(index),
+                "method": "POST",
+                "url": "/users",
+                "body": user_data,
+                "headers": {"Content-Type": "application/json"},
+            }
+            for index, user_data in enumerate(users)
+        ]
+
+    @classmethod
+    def _user_lookup_params(cls, email: Optional[str] = None, given_name: Optional[str] = None) -> Optional[dict]:
+        """
+        Build the query parameters for looking up a single user by email or given name.
+
+        Returns:
+            dict: Query parameters for the /users endpoint, or None if there is nothing to filter on.
+
+        """
+        filters = []
+        if email:
+            filters.append(f"mail eq '{cls._escape_odata_string(email)}'")
+
+        if given_name:
+            filters.append(f"givenName eq '{cls._escape_odata_string(given_name)}'")
+
+        if not filters:
+            return None
+
+        return {
+            "$filter": " or ".join(filters),
+            "$top": 1,
+            "$count": "true",
+            "$select": configs.user_select_fields,
+        }
+
+    @staticmethod
+    def _escape_odata_string(value: str) -> str:
+        """
+        Escape a value for use inside a quoted OData string literal.
+        """
+        return value.replace("'", "''")
 
     def _get_graph_api_access_token(self):
         """
         Retrieve the access token for Microsoft Graph API using client credentials.
+        Tokens are cached per (client_id, tenant_id) until shortly before they expire.
 
         Returns:
             str: Access token for Microsoft Graph API.
@@ -231,19 +491,14 @@ class GraphAPI:
             HTTPError: If there's an error in the request or response.
 
         """
-        request_data = {
-            "client_id": self.client_id,
-            "scope": "https://graph.microsoft.com/.default",
-            "client_secret": self.client_secret,
-            "grant_type": "client_credentials",
-        }
+        cached_token = get_cached_access_token(self.client_id, self.tenant_id)
+        if cached_token:
+            return cached_token
 
+        url, request_data = access_token_request(self.client_id, self.client_secret, self.tenant_id)
         headers = {"Content-Type": "application/x-www-form-urlencoded"}
-        url = f"https://login.microsoftonline.com/{self.tenant_id}/oauth2/v2.0/token"
 
-        response = requests.post(url, data=request_data, headers=headers)
+        response = _SESSION.post(url, data=request_data, headers=headers)
         response.raise_for_status()
 
-        token_data = response.json()
-        return token_data["access_token"]
-
+        return cache_access_token(self.client_id, self.tenant_id, json_loads(response.content))
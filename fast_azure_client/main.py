@@ -1,13 +1,28 @@
 from typing import Optional
-
-from furl import furl
-from msal import ConfidentialClientApplication
-from msal.authority import (AuthorityBuilder, AZURE_PUBLIC)
+from functools import lru_cache
+from urllib.parse import urlsplit, parse_qsl
 
 from .graph_utils import GraphAPI
 from .fastapi_utils.auth_handler import AuthHandler
 
 
+@lru_cache(maxsize=32)
+def _msal_app(client_id: str, client_secret: str, authority: Optional[str]):
+    """
+    Get a shared msal application for the given credentials, so tenant discovery and
+    the token cache are reused across AuthClient instances.
+    """
+    # msal is imported lazily so processes that only use the graph utils don't load it
+    from msal import ConfidentialClientApplication, SerializableTokenCache
+
+    return ConfidentialClientApplication(
+        client_id=client_id,
+        client_credential=client_secret,
+        authority=authority,
+        token_cache=SerializableTokenCache()
+    )
+
+
 class AuthClient:
     """
     Client for handling authentication and authorization operations. \n
@@ -62,12 +77,9 @@ class AuthClient:
 
         self.auth_session_data = {}  # used for storing config data for completing auth flows
 
-        # initiate msal application
-        self.app = ConfidentialClientApplication(
-            client_id=client_id,
-            client_credential=client_secret,
-            authority=authority
-        )
+        # get the shared msal application (authority is normalised to a string so it can be cached,
+        # None is kept as is so msal falls back to its default authority)
+        self.app = _msal_app(client_id, client_secret, str(authority) if authority is not None else None)
 
     def generate_auth_url(
             self,
@@ -130,7 +142,7 @@ class AuthClient:
         """
         parses the returned url after completing the sign-on process, and return the query parameters as a dictionary
         """
-        return dict(furl(url).args)
+        return dict(parse_qsl(urlsplit(url).query, keep_blank_values=True))
 
     def authenticate_email_password(self, email: str, password: str, scopes: list = None):
         """
@@ -178,10 +190,13 @@ class AuthClient:
             self.client_secret
         )
 
-    def fastapi_auth_handler(self):
+    def fastapi_auth_handler(self, jwks_url: Optional[str] = None):
         """
         Get an authentication handler for FastAPI integration. \n
 
+        Args:
+            jwks_url (str, optional): The JWKS url used to verify token signatures. Defaults to None. \n
+
         Returns:
             AuthHandler: The AuthHandler object. \n
 
@@ -189,7 +204,8 @@ class AuthClient:
         return AuthHandler(
             self.client_id,
             self.client_secret,
-            self.oauth_tenant_id
+            self.oauth_tenant_id,
+            jwks_url=jwks_url
         )
 
     @staticmethod
@@ -206,6 +222,8 @@ class AuthClient:
             str: The generated authority URL. \n
 
         """
+        from msal.authority import (AuthorityBuilder, AZURE_PUBLIC)
+
         if mode == 'b2c' and user_flow:
             return f'https://{tenant_name}.b2clogin.com/{tenant_name}.onmicrosoft.com/{user_flow}'
 
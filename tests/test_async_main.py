@@ -0,0 +1,93 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from fast_azure_client.graph_utils import async_main, main
+
+
+@pytest.fixture
+def graph(monkeypatch):
+    """
+    Serve graph and token endpoint requests from a mock transport, issuing a new token per token request.
+    """
+    calls = {"tokens": 0, "authorization": []}
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if "oauth2" in str(request.url):
+            calls["tokens"] += 1
+            return httpx.Response(200, json={"access_token": f"T{calls['tokens']}", "expires_in": 3600})
+
+        calls["authorization"].append(request.headers["Authorization"])
+        return httpx.Response(200, json={"value": [{"id": "user"}]})
+
+    async_client = {}
+
+    def get_async_client():
+        loop = asyncio.get_running_loop()
+        if loop not in async_client:
+            async_client[loop] = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        return async_client[loop]
+
+    monkeypatch.setattr(async_main, "_get_async_client", get_async_client)
+    monkeypatch.setattr(main, "_TOKEN_CACHE", {})
+    return calls
+
+
+def test_app_token_is_refreshed_after_it_expires(graph):
+    api = async_main.AsyncGraphAPI(client_id="client", tenant_id="tenant", client_secret="secret")
+
+    async def lookups():
+        await api.get_user_details(email="a@example.com")
+        await api.get_user_details(email="b@example.com")
+
+        # force the shared cache entry to expire
+        main._TOKEN_CACHE[("client", "tenant")] = ("T1", 0.0)
+        await api.get_user_details(email="c@example.com")
+
+    asyncio.run(lookups())
+
+    assert graph["tokens"] == 2
+    assert graph["authorization"] == ["Bearer T1", "Bearer T1", "Bearer T2"]
+
+
+def test_caller_provided_token_is_used_as_is(graph):
+    api = async_main.AsyncGraphAPI(access_token="given")
+
+    asyncio.run(api.get_user_details(email="a@example.com"))
+
+    assert graph["tokens"] == 0
+    assert graph["authorization"] == ["Bearer given"]
+
+
+def test_create_users_returns_status_and_body_per_user(monkeypatch):
+    batches = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        sub_requests = json.loads(request.content)["requests"]
+        batches.append([sub_request["id"] for sub_request in sub_requests])
+
+        responses = []
+        for sub_request in sub_requests:
+            if sub_request["id"] == "1" and len(batches) == 1:
+                responses.append({"id": "1", "status": 429, "headers": {"Retry-After": "0"}})
+            elif sub_request["body"].get("invalid"):
+                responses.append({"id": sub_request["id"], "status": 400, "body": {"error": {"code": "Request_BadRequest"}}})
+            else:
+                responses.append({"id": sub_request["id"], "status": 201, "body": {"id": f"user{sub_request['id']}"}})
+
+        return httpx.Response(200, json={"responses": responses})
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(async_main, "_get_async_client", lambda: client)
+
+    api = async_main.AsyncGraphAPI(access_token="given")
+    results = asyncio.run(api.create_users_on_azure([{}, {}, {"invalid": True}]))
+
+    assert batches == [["0", "1", "2"], ["1"]]
+    assert results == [
+        (201, {"id": "user0"}),
+        (201, {"id": "user1"}),
+        (400, {"error": {"code": "Request_BadRequest"}}),
+    ]
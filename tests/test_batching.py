@@ -0,0 +1,150 @@
+import asyncio
+import threading
+
+import httpx
+import pytest
+
+from fast_azure_client.graph_utils import batching
+from fast_azure_client.graph_utils.batching import BatchingGraphClient
+
+
+def _user_response(request: dict) -> dict:
+    return {"id": request["id"], "status": 200, "body": {"value": [{"url": request["url"]}]}}
+
+
+@pytest.fixture
+def sent_batches(monkeypatch):
+    """
+    Replace the graph $batch call, recording every batch and answering each lookup with its own url.
+    """
+    batches = []
+
+    async def send_batch(self, batch_requests, max_retries=3):
+        batches.append(batch_requests)
+        return {request["id"]: _user_response(request) for request in batch_requests}
+
+    monkeypatch.setattr(batching.AsyncGraphAPI, "send_batch", send_batch)
+    return batches
+
+
+def _client() -> BatchingGraphClient:
+    return BatchingGraphClient(client_id="client", client_secret="secret", tenant_id="tenant")
+
+
+def test_concurrent_lookups_are_coalesced_into_batches(sent_batches):
+    client = _client()
+
+    async def lookup_all():
+        return await asyncio.gather(*[client.get_user_details(email=f"user{i}@example.com") for i in range(25)])
+
+    users = asyncio.run(lookup_all())
+
+    assert [len(batch) for batch in sent_batches] == [20, 5]
+    for i, user in enumerate(users):
+        assert f"user{i}%40example.com" in user["url"]
+
+
+def test_identical_lookups_share_a_sub_request(sent_batches):
+    client = _client()
+
+    async def lookup_all():
+        return await asyncio.gather(*[client.get_user_details(email="same@example.com") for _ in range(5)])
+
+    users = asyncio.run(lookup_all())
+
+    assert [len(batch) for batch in sent_batches] == [1]
+    assert all(user == users[0] for user in users)
+
+    # every caller gets its own copy
+    users[0]["url"] = "changed"
+    assert users[1]["url"] != "changed"
+
+
+def test_lookup_without_filters_skips_graph(sent_batches):
+    assert asyncio.run(_client().get_user_details()) is None
+    assert sent_batches == []
+
+
+def test_batch_failure_is_raised_for_every_caller(monkeypatch):
+    async def send_batch(self, batch_requests, max_retries=3):
+        raise httpx.ConnectError("graph is down")
+
+    monkeypatch.setattr(batching.AsyncGraphAPI, "send_batch", send_batch)
+    client = _client()
+
+    async def lookup_all():
+        return await asyncio.wait_for(asyncio.gather(
+            client.get_user_details(email="a@example.com"),
+            client.get_user_details(email="b@example.com"),
+            return_exceptions=True
+        ), timeout=2)
+
+    results = asyncio.run(lookup_all())
+    assert all(isinstance(result, httpx.ConnectError) for result in results)
+
+
+def test_failed_sub_request_only_fails_its_caller(monkeypatch):
+    async def send_batch(self, batch_requests, max_retries=3):
+        responses = {request["id"]: _user_response(request) for request in batch_requests}
+        for request in batch_requests:
+            if "missing" in request["url"]:
+                responses[request["id"]] = {"id": request["id"], "status": 404,
+                                            "body": {"error": {"message": "not found"}}}
+        return responses
+
+    monkeypatch.setattr(batching.AsyncGraphAPI, "send_batch", send_batch)
+    client = _client()
+
+    async def lookup_all():
+        return await asyncio.gather(
+            client.get_user_details(email="found@example.com"),
+            client.get_user_details(email="missing@example.com"),
+            return_exceptions=True
+        )
+
+    found, missing = asyncio.run(lookup_all())
+    assert "found" in found["url"]
+    assert isinstance(missing, httpx.HTTPStatusError)
+    assert missing.response.status_code == 404
+
+
+def test_unexpected_response_fails_callers_instead_of_hanging(monkeypatch):
+    async def send_batch(self, batch_requests, max_retries=3):
+        return {request["id"]: {"id": request["id"], "status": 200, "body": {}} for request in batch_requests}
+
+    monkeypatch.setattr(batching.AsyncGraphAPI, "send_batch", send_batch)
+    client = _client()
+
+    async def lookup():
+        return await asyncio.wait_for(client.get_user_details(email="a@example.com"), timeout=2)
+
+    with pytest.raises(KeyError):
+        asyncio.run(lookup())
+
+
+def test_client_works_across_event_loops(sent_batches):
+    client = _client()
+
+    async def lookup(email):
+        return await asyncio.wait_for(client.get_user_details(email=email), timeout=2)
+
+    # sequential loops, as with repeated asyncio.run calls
+    for i in range(3):
+        user = asyncio.run(lookup(f"loop{i}@example.com"))
+        assert f"loop{i}" in user["url"]
+
+    # a loop running in another thread at the same time as this one
+    results = {}
+
+    def lookup_in_thread():
+        results["thread"] = asyncio.run(lookup("thread@example.com"))
+
+    async def lookup_here():
+        thread = threading.Thread(target=lookup_in_thread)
+        thread.start()
+        user = await lookup("main@example.com")
+        await asyncio.to_thread(thread.join, 5)
+        return user
+
+    assert "main" in asyncio.run(lookup_here())["url"]
+    assert "thread" in results["thread"]["url"]
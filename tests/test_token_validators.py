@@ -0,0 +1,196 @@
+import json
+import threading
+import time
+
+import jwt
+import pytest
+import requests
+from cryptography.hazmat.primitives.asymmetric import rsa
+from fastapi import HTTPException
+from jwt.algorithms import RSAAlgorithm
+
+from fast_azure_client.fastapi_utils import token_validators
+
+
+JWKS_URL = "https://login.example.com/keys"
+CLIENT_ID = "client"
+
+
+class _JwksResponse:
+
+    def __init__(self, keys: list, headers: dict = None):
+        self.text = json.dumps({"keys": keys})
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        pass
+
+
+def _signing_key(kid: str):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+    public_jwk = json.loads(RSAAlgorithm.to_jwk(private_key.public_key()))
+    public_jwk.update({"kid": kid, "use": "sig"})
+    return private_key, public_jwk
+
+
+def _token(private_key, kid: str, **claims) -> str:
+    payload = {"aud": CLIENT_ID, "exp": int(time.time()) + 300, **claims}
+    return jwt.encode(payload, private_key, algorithm="RS256", headers={"kid": kid})
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    token_validators._TOKEN_CACHE.clear()
+    token_validators._JWKS_CACHE.clear()
+    token_validators._JWKS_FAILED_AT.clear()
+    yield
+
+
+@pytest.fixture
+def jwks_endpoint(monkeypatch):
+    """
+    Replace the jwks fetch, serving endpoint["keys"] (or raising endpoint["error"]) and counting calls.
+    """
+    endpoint = {"keys": [], "error": None, "calls": 0, "delay": 0.0}
+
+    def get(url, timeout=None):
+        endpoint["calls"] += 1
+        time.sleep(endpoint["delay"])
+        if endpoint["error"]:
+            raise endpoint["error"]
+        return _JwksResponse(endpoint["keys"], {"Cache-Control": "max-age=3600"})
+
+    monkeypatch.setattr(token_validators._SESSION, "get", get)
+    return endpoint
+
+
+def test_verified_token_is_decoded(jwks_endpoint):
+    private_key, public_jwk = _signing_key("k1")
+    jwks_endpoint["keys"] = [public_jwk]
+
+    payload = token_validators.decode_token(_token(private_key, "k1"), CLIENT_ID, jwks_url=JWKS_URL)
+
+    assert payload["aud"] == CLIENT_ID
+    assert jwks_endpoint["calls"] == 1
+
+
+def test_tampered_token_is_rejected(jwks_endpoint):
+    private_key, public_jwk = _signing_key("k1")
+    jwks_endpoint["keys"] = [public_jwk]
+
+    other_key, _ = _signing_key("k1")
+
+    with pytest.raises(HTTPException) as error:
+        token_validators.decode_token(_token(other_key, "k1"), CLIENT_ID, jwks_url=JWKS_URL)
+
+    assert error.value.status_code == 401
+
+
+@pytest.mark.parametrize("fetch_error", [
+    requests.ConnectionError("unreachable"),
+    requests.Timeout("timed out"),
+    requests.HTTPError("500 Server Error"),
+])
+def test_jwks_outage_without_cached_keys_is_a_503(jwks_endpoint, fetch_error):
+    private_key, _ = _signing_key("k1")
+    jwks_endpoint["error"] = fetch_error
+
+    with pytest.raises(HTTPException) as error:
+        token_validators.decode_token(_token(private_key, "k1"), CLIENT_ID, jwks_url=JWKS_URL)
+
+    assert error.value.status_code == 503
+
+
+def test_invalid_jwks_is_a_503(jwks_endpoint):
+    private_key, _ = _signing_key("k1")
+    jwks_endpoint["keys"] = []  # PyJWKSet rejects a key set without usable keys
+
+    with pytest.raises(HTTPException) as error:
+        token_validators.decode_token(_token(private_key, "k1"), CLIENT_ID, jwks_url=JWKS_URL)
+
+    assert error.value.status_code == 503
+
+
+def test_stale_keys_are_served_while_the_jwks_is_unavailable(jwks_endpoint):
+    private_key, public_jwk = _signing_key("k1")
+    jwks_endpoint["keys"] = [public_jwk]
+
+    token_validators.get_signing_key(JWKS_URL, "k1")
+
+    # expire the cached key set and take the endpoint down
+    keys, fetched_at, _ = token_validators._JWKS_CACHE[JWKS_URL]
+    token_validators._JWKS_CACHE[JWKS_URL] = (keys, fetched_at, time.monotonic() - 1)
+    jwks_endpoint["error"] = requests.ConnectionError("unreachable")
+
+    payload = token_validators.decode_token(_token(private_key, "k1", name="first"), CLIENT_ID, jwks_url=JWKS_URL)
+    assert payload["name"] == "first"
+
+    # failed fetches are not retried straight away
+    token_validators.decode_token(_token(private_key, "k1", name="second"), CLIENT_ID, jwks_url=JWKS_URL)
+    assert jwks_endpoint["calls"] == 2
+
+
+def test_concurrent_cache_misses_fetch_the_jwks_once(jwks_endpoint):
+    _, public_jwk = _signing_key("k1")
+    jwks_endpoint["keys"] = [public_jwk]
+    jwks_endpoint["delay"] = 0.1
+
+    threads = [threading.Thread(target=token_validators.get_signing_key, args=(JWKS_URL, "k1")) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert jwks_endpoint["calls"] == 1
+
+
+def test_jwks_fetch_is_only_required_on_a_cache_miss(jwks_endpoint):
+    private_key, public_jwk = _signing_key("k1")
+    jwks_endpoint["keys"] = [public_jwk]
+    token = _token(private_key, "k1")
+
+    assert not token_validators.requires_jwks_fetch(token, None)
+    assert token_validators.requires_jwks_fetch(token, JWKS_URL)
+
+    token_validators.decode_token(token, CLIENT_ID, jwks_url=JWKS_URL)
+
+    # the decoded token is cached, and other tokens signed with the cached key verify in memory
+    assert not token_validators.requires_jwks_fetch(token, JWKS_URL)
+    assert not token_validators.requires_jwks_fetch(_token(private_key, "k1", name="other"), JWKS_URL)
+
+
+@pytest.mark.parametrize("claims, authorized", [
+    ({"appid": CLIENT_ID, "aud": "graph"}, True),
+    ({"aud": CLIENT_ID}, True),
+    ({"appid": "other", "aud": CLIENT_ID}, False),
+    ({"aud": "other"}, False),
+])
+def test_helpers_and_decode_token_agree_on_the_audience(claims, authorized):
+    payload = {"exp": int(time.time()) + 300, **claims}
+    token = jwt.encode(payload, "a-test-secret-of-at-least-32-bytes", algorithm="HS256")
+
+    if authorized:
+        token_validators.verify_user_is_authorized_for_this_app(payload, CLIENT_ID)
+        assert token_validators.decode_token(token, CLIENT_ID)["exp"] == payload["exp"]
+        return
+
+    for check in (lambda: token_validators.verify_user_is_authorized_for_this_app(payload, CLIENT_ID),
+                  lambda: token_validators.decode_token(token, CLIENT_ID)):
+        with pytest.raises(HTTPException) as error:
+            check()
+        assert error.value.status_code == 401
+
+
+def test_cached_token_is_rejected_once_expired():
+    payload = {"aud": CLIENT_ID, "exp": int(time.time()) + 300}
+    token = jwt.encode(payload, "a-test-secret-of-at-least-32-bytes", algorithm="HS256")
+    token_validators.decode_token(token, CLIENT_ID)
+
+    cache_key = token_validators._token_cache_key(token, None)
+    token_validators._TOKEN_CACHE[cache_key] = {**payload, "exp": int(time.time()) - 1}
+
+    with pytest.raises(HTTPException) as error:
+        token_validators.decode_token(token, CLIENT_ID)
+
+    assert error.value.detail == 'Signature has expired'